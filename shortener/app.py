@@ -1,7 +1,10 @@
 import sys
 import logging
+import threading
 
+import orjson
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
 
@@ -22,12 +25,25 @@ def configure_default_logging():
     logging.captureWarnings(True)
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson, which is much faster than the
+    standard library for request.get_json() and jsonify().
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 configure_default_logging()
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-# No limit on form size (e.g. very long links)
-app.config['MAX_FORM_MEMORY_SIZE'] = None
+# Allow very long links, but keep a (generous) limit on form size
+app.config['MAX_FORM_MEMORY_SIZE'] = 64 * 1024 * 1024
 
 # TODO: Limit origin list here: CORS(app, origins=[...])
 #CORS(app, origins=[r'.*\.janelia\.org', r'neuroglancer-demo\.appspot\.com'], supports_credentials=True)
@@ -47,6 +63,25 @@ def _shortener():
     return shortener()
 
 
+def _warm_up():
+    from shortener.shortng import warm_up
+    warm_up()
+
+
+def start_warm_up():
+    """
+    Do the one-time setup now, rather than during the first request.
+    It runs in the background so that requests that don't need it
+    (e.g. the form page) can be served right away.
+
+    This isn't done on import, so that the tests (and anything else that
+    imports the app) don't reach out to GCS; the server calls it instead,
+    via the post_worker_init hook in gunicorn_config.py.
+    """
+    threading.Thread(target=_warm_up, daemon=True).start()
+
+
 if __name__ == "__main__":
     print("Debug launch on http://0.0.0.0:8000")
+    start_warm_up()
     app.run(host='0.0.0.0', port=8000, debug=True)
@@ -0,0 +1,9 @@
+"""
+gunicorn settings for the shortener; see the Dockerfile's CMD.
+"""
+
+
+def post_worker_init(worker):
+    # each worker has its own storage client and token, so each warms up its own
+    from shortener.app import start_warm_up
+    start_warm_up()
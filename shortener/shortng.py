@@ -1,16 +1,25 @@
+import concurrent.futures
 import datetime
 import enum
 import functools
+import gzip
 import hashlib
+import hmac
 import json
 import logging
 import os
-import urllib
-import tempfile
+import string
+import urllib.parse
+import urllib.request
+import threading
+import time
 from textwrap import dedent
 
-from google.cloud import storage
-from flask import Response, request, jsonify, render_template
+import cachetools
+import orjson
+from flask import Response, current_app, g, request, jsonify
+from markupsafe import escape
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 
 logger = logging.getLogger(__name__)
 
@@ -19,13 +28,101 @@ SHORTNG_PASSWORD_BUCKET = 'flyem-user-links-private'
 
 BUCKET_LINK_SEPARATOR = "#!gs://"
 
+# shortened links are stored under this prefix in the bucket
+BLOB_PREFIX = "short/"
+
 SHORTENER_URL = "https://shortng-bmcp5imp6q-uc.a.run.app/shortener.html"
 CLIO_URL = "https://clio-ng.janelia.org/"
 
+# when re-shortening a link from our bucket that our service account can't
+#   read, fall back to downloading the state via its public URL; set to 0 to disable
+PUBLIC_DOWNLOAD_FALLBACK = os.environ.get('PUBLIC_DOWNLOAD_FALLBACK', '1') != '0'
+
+# url-encoded form bodies larger than this (i.e. very long links) are parsed
+#   by _request_form() in one pass, rather than by werkzeug's form parser
+LARGE_FORM_BYTES = 64 * 1024
+# Slack sends about a dozen fields; we only use a few of them
+MAX_FORM_FIELDS = 32
+# uploads at least this large are stored gzip-compressed; below it,
+#   compression saves too little to be worth it
+GZIP_MIN_BYTES = 2048
+GZIP_MAGIC = b'\x1f\x8b'
+
+# links (or JSON states) longer than this are rejected before decoding them
+MAX_LINK_LENGTH = 10 * 1024 * 1024
+
 # password hashing parameters
 SALT_WIDTH = 16
 DKLEN_WIDTH = 32
 
+# KDF for newly stored passwords, 'scrypt', 'argon2id', or 'pbkdf2-sha256'; the KDF
+#   parameters are stored alongside each hash, so changing this or the
+#   costs below doesn't invalidate old passwords
+PASSWORD_KDF = os.environ.get('PASSWORD_KDF', 'scrypt')
+
+# scrypt cost for newly stored passwords
+SCRYPT_N = int(os.environ.get('SCRYPT_N', 16384))
+# scrypt parallelization; note that OpenSSL computes the p lanes one after
+#   another, so each hash costs p times as much CPU, on a single core
+SCRYPT_P = int(os.environ.get('SCRYPT_P', 1))
+# optionally, raise SCRYPT_N for as long as a hash stays within this many ms;
+#   never goes below SCRYPT_N or above SCRYPT_MAX_N
+SCRYPT_TARGET_MS = os.environ.get('SCRYPT_TARGET_MS')
+SCRYPT_MAX_N = 2**17
+
+# argon2id costs for newly stored passwords (memory in KiB); unlike OpenSSL's
+#   scrypt, argon2 computes its lanes in parallel threads, so on a multi-core
+#   instance a hash takes about as long with ARGON2_PARALLELISM lanes as with one
+ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', 2))
+ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', 65536))
+ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM', 4))
+
+# PBKDF2-HMAC-SHA256 iterations for newly stored passwords (OWASP guidance)
+PBKDF2_ITERS = int(os.environ.get('PBKDF2_ITERS', 600_000))
+
+# parameters used for passwords stored before the parameters were stored
+#   with the hash; those files contain only the hash followed by the salt
+LEGACY_KDF_PARAMS = {"kdf": "scrypt", "n": 16384, "r": 8, "p": 1, "dklen": DKLEN_WIDTH}
+
+# recently verified passwords, so repeated saves with the same password skip
+#   the KDF; entries are keyed by an HMAC with a per-process secret, so no
+#   plaintext passwords are held in memory
+_VERIFIED_PASSWORD_SECRET = os.urandom(32)
+_VERIFIED_PASSWORDS = cachetools.TTLCache(maxsize=1024, ttl=300)
+_VERIFIED_PASSWORDS_LOCK = threading.Lock()
+
+# Cache-Control for link states: viewers (and Google's edge caches) may
+#   reuse a state for up to five minutes, so an edit can take that long to show
+STATE_CACHE_CONTROL = 'public, max-age=300'
+
+# recently downloaded password data, keyed by password filename. Password
+#   files are only ever created (never rewritten), so a cached file can't be
+#   stale; a missing file is never cached, since one may be created any time.
+#   (An admin replacing or deleting a password file by hand is only seen once
+#   the entry expires; see the README.)
+_PASSWORD_DATA = cachetools.TTLCache(maxsize=1024, ttl=60)
+_PASSWORD_DATA_LOCK = threading.Lock()
+
+# the timestamp (in microseconds) of the last default filename handed out
+_LAST_DEFAULT_FILENAME_US = 0
+_DEFAULT_FILENAME_LOCK = threading.Lock()
+
+# refresh the storage access token this many seconds before it expires;
+#   google-auth itself would refresh (synchronously, in a request) ~4 min before
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Slack expects a reply to a slash command within 3 s; if the upload takes
+#   longer than this, the link is posted to the command's response_url instead
+SLACK_REPLY_SECONDS = 2.5
+SLACK_RESPONSE_URL_PREFIX = "https://hooks.slack.com/"
+
+# number of pooled HTTPS connections kept open to GCS
+HTTP_POOL_SIZE = 20
+
+# shared pool for issuing independent GCS requests concurrently;
+#   the storage client is thread-safe
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
 
 class RequestSource(enum.Enum):
     WEB = "web"
@@ -54,10 +151,9 @@ class ErrMsg(RuntimeError):
 
 
 def shortener():
-    filename = request.args.get('filename', "")
-    title = request.args.get('title', "")
-    text = request.args.get('text', "")
-    return render_template('shortener.html', filename=filename, title=title, text=text)
+    # The page is static; it fills in the filename, title, and text
+    # fields from the query string itself.
+    return current_app.send_static_file('shortener.html')
 
 
 def shortng():
@@ -70,6 +166,24 @@ def shortng():
         raise
 
 
+def warm_up():
+    """
+    Set up the storage client and bucket handles, fetch an access token (and
+    keep it fresh), and calibrate the password hashing cost, so the first
+    request doesn't have to wait for them.
+    """
+    try:
+        _get_client()
+        _refresh_credentials()
+        _get_bucket(SHORTNG_PASSWORD_BUCKET)
+        # a cheap request, so we're authenticated and connected before the first real one
+        _get_bucket(SHORTNG_BUCKET).reload()
+    except Exception as ex:
+        logger.warning(f"Could not warm up the storage client: {ex}")
+    # (calibrates the scrypt cost, if configured)
+    _kdf_params()
+
+
 def _shortng():
     """
     Handle a request to shorten a neuroglancer link,
@@ -92,70 +206,206 @@ def _shortng():
     """
     filename, title, password, link, source = _parse_request()
 
-    url_base, state = _parse_state(link, source)
+    # the password is only used as bytes (by the KDF), so encode it just once
+    password = (password or "").encode('utf-8')
+
+    # re-saving a link from our bucket, unchanged, under a new name doesn't
+    #   need the state itself; GCS can copy it directly
+    copy_blob_name = _copyable_blob_name(link, title, filename)
+    if copy_blob_name:
+        url_base, _, _ = _parse_link(link)
+        _check_url_base(url_base, source)
+        # the copy's metadata is based on its source's; fetch that alongside the link's
+        copy_source_future = _EXECUTOR.submit(_get_bucket(SHORTNG_BUCKET).get_blob, copy_blob_name)
+    else:
+        url_base, state = _parse_state(link, source)
 
     # check if the link has already been shortened; if it has, check if
     #   it's editable (i.e. password is correct and it's not too old)
-    has_password_file = _file_exists(SHORTNG_PASSWORD_BUCKET, _password_filename(filename))
-    _raise_if_not_editable(filename, has_password_file, password, source)
-
-    if title:
-        state['title'] = title
-
-    # the actual work
-    bucket_path = _upload_state(state, filename)
+    link_blob, stored_password_data = _gather_blob_metadata(filename)
+    has_password_file = stored_password_data is not None
+    _raise_if_not_editable(filename, link_blob, stored_password_data, password, source)
+
+    # the actual work; the link's location doesn't depend on the upload,
+    #   so the response is built while the upload is in flight. The write only
+    #   succeeds if the link is still the version we checked above (or still
+    #   doesn't exist), so concurrent saves can't clobber each other.
+    generation = link_blob.generation if link_blob is not None else 0
+    if copy_blob_name:
+        upload_future = _EXECUTOR.submit(_copy_state, copy_blob_name, copy_source_future.result(),
+                                         filename, source, generation)
+    else:
+        if title:
+            state['title'] = title
+        upload_future = _EXECUTOR.submit(_upload_state, state, filename, generation)
+    bucket_path = _bucket_path(filename)
     url = f'{url_base}#!gs://{bucket_path}'
-    logger.info(f"Completed {url}")
 
-    # if password was provided and password file doesn't exist, store it; we store
-    #    in individual files per link to avoid race conditions
-    if password and not has_password_file:
-        salt = _new_salt()
-        hashed_password = _hash_password(password, salt)
-        _store_hashed_password_salt(_password_filename(filename), hashed_password, salt)
-        logger.info(f"Stored password for {_password_filename(filename)}")
-
-    # and finally the response to the user
+    # the response to the user
     match source:
         case RequestSource.SLACK:
-            return jsonify({"text": url, "response_type": "ephemeral"})
+            response = jsonify({"text": url, "response_type": "ephemeral"})
         case RequestSource.WEB:
-            return _web_response(url, bucket_path)
+            response = _web_response(url, bucket_path)
         case RequestSource.API_JSON:
-            return jsonify({"link": url})
+            response = jsonify({"link": url})
         case RequestSource.API_PLAIN:
-            return Response(url, 200)
+            response = Response(url, 200)
+
+    # Slack gives up on a reply after 3 seconds. If the upload is slow,
+    #   acknowledge the command now and post the link to the command's
+    #   response_url once it's saved. (Slack requests never have a password.)
+    if source is RequestSource.SLACK:
+        response_url = _request_form().get('response_url', '')
+        if response_url.startswith(SLACK_RESPONSE_URL_PREFIX):
+            done, _ = concurrent.futures.wait([upload_future], timeout=SLACK_REPLY_SECONDS)
+            if not done:
+                # posting blocks on the network, so it gets a thread of its own
+                #   rather than tying up an _EXECUTOR worker
+                threading.Thread(target=_post_slack_reply, daemon=True,
+                                 args=(response_url, url, filename, upload_future)).start()
+                return jsonify({"text": "Saving your link; it will be posted here shortly.",
+                                "response_type": "ephemeral"})
+
+    # if password was provided and password file doesn't exist, store it; we store
+    #    in individual files per link to avoid race conditions. The hash is
+    #    computed while the upload is in flight, but only stored after it succeeds.
+    store_password = password and not has_password_file
+    if store_password:
+        salt = _new_salt()
+        params = _kdf_params()
+        hashed_password = _hash_password(password, salt, params)
+
+    from google.api_core.exceptions import PreconditionFailed
+    try:
+        upload_future.result()
+        logger.info("Completed %s", url)
+
+        if store_password:
+            _store_hashed_password_salt(_password_filename(filename), params, hashed_password, salt)
+            logger.info("Stored password for %s", _password_filename(filename))
+    except PreconditionFailed as ex:
+        msg = _concurrent_save_msg(filename)
+        logger.error(msg)
+        raise ErrMsg(msg, source) from ex
+
+    return response
+
+
+def _concurrent_save_msg(filename):
+    return f"The link with filename {filename} was saved by someone else at the same time. Please try again."
+
+
+def _post_slack_reply(response_url, url, filename, upload_future):
+    """
+    Wait for a Slack request's upload, then post its outcome to the request's
+    response_url; used for uploads that outlast Slack's reply deadline.
+    """
+    from google.api_core.exceptions import PreconditionFailed
+
+    try:
+        upload_future.result()
+        logger.info("Completed %s", url)
+        text = url
+    except ErrMsg as ex:
+        text = ex.msg
+    except PreconditionFailed:
+        text = _concurrent_save_msg(filename)
+    except Exception as ex:
+        # the details (GCS, auth) are for our logs, not for the Slack user
+        logger.error(f"Could not save {url}: {ex}")
+        text = "Sorry, the link could not be saved. Please try again."
+
+    body = orjson.dumps({"text": text, "response_type": "ephemeral"})
+    slack_request = urllib.request.Request(response_url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(slack_request, timeout=10):
+            pass
+    except Exception as ex:
+        logger.error(f"Could not post the Slack reply for {url}: {ex}")
+
+
+@functools.cache
+def _get_credentials():
+    # The *contents* of the credentials are stored in the environment
+    # via the CloudRun settings, so build the credentials from them
+    # directly rather than writing them to a file first.
+    # The google libraries are slow to import, so import them only when needed.
+    from google.cloud import storage
+    from google.oauth2 import service_account
+
+    info = json.loads(os.environ['GOOGLE_APPLICATION_CREDENTIALS_CONTENTS'])
+    return service_account.Credentials.from_service_account_info(info, scopes=storage.Client.SCOPE)
+
+
+def _refresh_credentials():
+    """
+    Fetch a fresh access token now, and schedule the next refresh shortly
+    before it expires, so requests never have to wait for a token exchange.
+    """
+    from google.auth.transport.requests import Request
+
+    credentials = _get_credentials()
+    try:
+        credentials.refresh(Request())
+    except Exception as ex:
+        logger.warning(f"Could not refresh the storage credentials: {ex}")
+        delay = 60
+    else:
+        # (expiry is a naive UTC datetime)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        delay = max(60, (credentials.expiry - now).total_seconds() - TOKEN_REFRESH_MARGIN)
+
+    timer = threading.Timer(delay, _refresh_credentials)
+    timer.daemon = True
+    timer.start()
 
 
 @functools.cache
 def _get_client():
-    # HACK:
-    # I store the *contents* of the credentials in the environment
-    # via the CloudRun settings, but the google API wants a filepath,
-    # not a JSON string.
-    # So I write the JSON text into a file before uploading.
-    _fd, creds_path = tempfile.mkstemp('.json')
-    with open(creds_path, 'w') as f:
-        f.write(os.environ['GOOGLE_APPLICATION_CREDENTIALS_CONTENTS'])
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = creds_path
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    credentials = _get_credentials()
+    project = json.loads(os.environ['GOOGLE_APPLICATION_CREDENTIALS_CONTENTS'])['project_id']
+
+    # The default session keeps at most 10 connections per host; size the pool
+    # so the request threads and _EXECUTOR can all keep their connections alive.
+    # Retry failures to (re)connect, e.g. a pooled connection that was dropped;
+    # nothing was sent yet, so that's safe for any request. Other failures are
+    # left to the storage client's own retry policies.
+    session = AuthorizedSession(credentials)
+    retries = Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+    session.mount('https://', adapter)
+    return storage.Client(project=project, credentials=credentials, _http=session)
 
-    return storage.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'])
+
+@functools.cache
+def _get_bucket(bucket_name):
+    # Unlike get_bucket(), bucket() doesn't fetch the bucket metadata;
+    # it just constructs a local handle, so no round-trip to GCS is needed.
+    return _get_client().bucket(bucket_name)
 
 
 def _parse_web_request():
-    title = request.form.get('title', None)
-    filename = request.form.get('filename', None)
-    password = request.form.get('password', "")
-    link = (request.form.get('text', None))
+    form = _request_form()
+    title = form.get('title', None)
+    filename = form.get('filename', None)
+    password = form.get('password', "")
+    link = (form.get('text', None))
     if link is not None:
         link = link.strip()
     return filename, title, password, link
 
 
 def _parse_slack_request(source):
-    text_data = request.form.get('text', None)
+    text_data = _request_form().get('text', "")
 
     # remove Slack "code" formatting in the /shortng command input
+    #   (strip() only examines the ends, so the rest of the link isn't scanned)
     text_data = text_data.strip(" `")
 
     if text_data == "":
@@ -167,16 +417,14 @@ def _parse_slack_request(source):
             f"{SHORTENER_URL}")
         raise ErrMsg(msg, source)
 
-    name_and_link = text_data.split(' ')
-    if len(name_and_link) == 0:
-        raise ErrMsg("Error: No link provided", source)
-
+    # only the first space matters; the link itself may contain many
+    name_and_link = text_data.split(' ', 1)
     if len(name_and_link) == 1:
         filename = None
         link = text_data
     else:
         filename = name_and_link[0]
-        link = text_data[len(filename):].strip()
+        link = name_and_link[1].strip()
 
     # our Slackbot does not support titles or passwords at this time
     title = None
@@ -186,10 +434,10 @@ def _parse_slack_request(source):
 
 
 def _parse_api_request(source):
-    if request.headers.get('Content-Type') == 'application/json':
-        data = json.loads(request.data)
-    else:
-        data = request.form
+    # get_json() returns None unless the body is JSON, and caches what it parses
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = _request_form()
     title = data.get('title', None)
     filename = data.get('filename', None)
     password = data.get('password', "")
@@ -204,6 +452,30 @@ def _parse_api_request(source):
     return filename, title, password, link
 
 
+def _request_form():
+    """
+    Return the request's form fields. Large url-encoded bodies are parsed
+    here with a single parse_qs() pass instead of werkzeug's form parser.
+    The result is cached on flask.g for the rest of the request.
+    """
+    if 'form' in g:
+        return g.form
+
+    content_length = request.content_length or 0
+    if request.mimetype == 'application/x-www-form-urlencoded' and content_length > LARGE_FORM_BYTES:
+        if request.max_form_memory_size is not None and content_length > request.max_form_memory_size:
+            raise RequestEntityTooLarge()
+        body = request.get_data(cache=False, as_text=True)
+        try:
+            fields = urllib.parse.parse_qs(body, keep_blank_values=True, max_num_fields=MAX_FORM_FIELDS)
+        except ValueError as ex:
+            raise BadRequest("Too many form fields") from ex
+        g.form = {key: values[0] for key, values in fields.items()}
+    else:
+        g.form = request.form
+    return g.form
+
+
 def _parse_request():
     """
     Extract basic fields from the request and make
@@ -213,15 +485,16 @@ def _parse_request():
         (filename, title, password, link, request source)
     """
 
-    if "Slackbot" in request.headers.get('User-Agent'):
+    headers = request.headers
+    if headers.get('User-Agent', '').startswith('Slackbot'):
         source = RequestSource.SLACK
-    elif request.form.get('client') == 'web':
+    elif _request_form().get('client') == 'web':
         source = RequestSource.WEB
-    elif request.headers.get('Content-Type') == 'application/json':
+    elif headers.get('Content-Type') == 'application/json':
         source = RequestSource.API_JSON
     else:
         source = RequestSource.API_PLAIN
-    logger.info(f"Request source: {source}")
+    logger.info("Request source: %s", source)
 
     match source:
         case RequestSource.WEB:
@@ -243,9 +516,8 @@ def _process_filename(filename):
     """
     common filename processing steps
     """
-    # default datetime filename
     if not filename:
-        filename = datetime.datetime.now().strftime('%Y-%m-%d.%H%M%S.%f')
+        filename = _default_filename()
 
     if not filename.endswith('.json'):
         filename += '.json'
@@ -256,16 +528,41 @@ def _process_filename(filename):
     return filename
 
 
+def _default_filename():
+    """
+    A datetime filename, e.g. 2024-01-31.235959.123456-3f9a. Each call in this
+    process gets a later microsecond than the last, so concurrent requests
+    don't end up saving to (and editing) the same default filename. Other
+    processes (gunicorn workers, Cloud Run instances) keep no shared counter,
+    so a random suffix keeps their names apart too.
+    """
+    global _LAST_DEFAULT_FILENAME_US
+    with _DEFAULT_FILENAME_LOCK:
+        timestamp_us = max(time.time_ns() // 1000, _LAST_DEFAULT_FILENAME_US + 1)
+        _LAST_DEFAULT_FILENAME_US = timestamp_us
+
+    # (formatted directly, which is cheaper than strftime)
+    seconds, microsecond = divmod(timestamp_us, 1_000_000)
+    now = datetime.datetime.fromtimestamp(seconds)
+    return (f"{now.year}-{now.month:02}-{now.day:02}."
+            f"{now.hour:02}{now.minute:02}{now.second:02}.{microsecond:06}-{os.urandom(2).hex()}")
+
+
 def _parse_state(link, source):
     """
     Extract the neuroglancer state JSON data from the given link. Returns
     the URL base and the state JSON. Raise ErrMsg if something went wrong.
     """
+    if len(link) > MAX_LINK_LENGTH:
+        msg = f"The link is too long ({len(link)} characters; the limit is {MAX_LINK_LENGTH})"
+        logger.error(msg)
+        raise ErrMsg(msg, source)
 
     # the link could be to a previously shortened link
     if BUCKET_LINK_SEPARATOR in link:
         url_base, bucket_name, blob_name = _parse_link(link)
-        data = _download_state_public(bucket_name, blob_name)
+        _check_url_base(url_base, source)
+        data = _download_state(bucket_name, blob_name)
         if data is None:
             msg = f"Could not retrieve json state from bucket {bucket_name}, blob {blob_name}"
             logger.error(msg)
@@ -275,7 +572,7 @@ def _parse_state(link, source):
     # or we allow JSON to be provided directly in the link variable
     if link.startswith('{'):
         try:
-            state = json.loads(link)
+            state = orjson.loads(link)
             # we default to the clio URL even though it could be some other neuroglancer
             return CLIO_URL, state
         except ValueError as ex:
@@ -284,102 +581,184 @@ def _parse_state(link, source):
             )
             raise ErrMsg(msg, source) from ex
 
-    # otherwise, we expect a link copied from neuroglancer
+    # otherwise, we expect a link copied from neuroglancer; check what's
+    #   cheap to check before parsing the (possibly large) state, which
+    #   is a JSON object, so it starts with '{' (or its escape, '%7B')
+    url_base, separator, encoded_json = link.partition('#!')
+    if not separator or not encoded_json[:3].upper().startswith(('{', '%7B')):
+        msg = f"Could not parse link:\n\n{link}"
+        logger.error(msg)
+        raise ErrMsg(msg, source)
+
+    _check_url_base(url_base, source)
+
     try:
-        url_base, encoded_json = link.split('#!')
-        encoded_json = urllib.parse.unquote(encoded_json)
-        state = json.loads(encoded_json)
+        # decode straight to bytes, which orjson parses without an intermediate str;
+        #   a fragment without any escapes can be parsed as it is
+        if '%' in encoded_json:
+            state = orjson.loads(urllib.parse.unquote_to_bytes(encoded_json))
+        else:
+            state = orjson.loads(encoded_json)
     except ValueError as ex:
         msg = f"Could not parse link:\n\n{link}"
         logger.error(msg)
         raise ErrMsg(msg, source) from ex
 
-    if not (url_base.startswith('http://') or url_base.startswith('https://')):
+    return url_base, state
+
+
+def _check_url_base(url_base, source):
+    """
+    Raise ErrMsg unless the link's base URL is http(s). The base URL ends up
+    in the links we return (and in the web result page), so any other scheme,
+    e.g. javascript:, is rejected for every kind of link.
+    """
+    if not url_base.startswith(('http://', 'https://')):
         msg = "Error: Filename must not contain spaces, and links must start with http or https"
         logger.error(msg)
         raise ErrMsg(msg, source)
 
-    return url_base, state
-
 
 def _parse_link(link):
     """
     split the link into the base url, the bucket name, and the blog name,
     regardless of which neuroglancer instance or bucket it's in
     """
-    url_base, blob_name = link.split(BUCKET_LINK_SEPARATOR)
-    bucket_name, blob_name = blob_name.split('/', 1)
+    url_base, _, bucket_path = link.partition(BUCKET_LINK_SEPARATOR)
+    bucket_name, _, blob_name = bucket_path.partition('/')
     return url_base, bucket_name, blob_name
 
 
+def _copyable_blob_name(link, title, filename):
+    """
+    If the link is a previously shortened link in our bucket that is being
+    re-saved without changes under a different filename, return the blob name
+    of its state, which can then be copied rather than re-uploaded.
+    Otherwise, return None.
+    """
+    if title or BUCKET_LINK_SEPARATOR not in link:
+        return None
+    _, bucket_name, blob_name = _parse_link(link)
+    if bucket_name != SHORTNG_BUCKET or blob_name == _blob_name(filename):
+        return None
+    return blob_name
+
+
 def _blob_name(filename):
-    return f"short/{filename}"
+    return BLOB_PREFIX + filename
+
+
+def _bucket_path(filename):
+    return f'{SHORTNG_BUCKET}/{_blob_name(filename)}'
 
 
 def _password_filename(filename):
     return filename.removesuffix('.json')
 
 
-def _file_exists(bucket_name, filename):
+def _gather_blob_metadata(filename):
     """
-    Determine whether a file exists for the given filename.
+    Fetch the link's blob metadata and its stored password data (if any)
+    concurrently, since neither request depends on the other.
+
+    Returns:
+        (link blob or None, stored password data or None)
     """
-    bucket = _get_client().get_bucket(bucket_name)
-    blob = bucket.get_blob(_blob_name(filename))
-    return blob is not None and blob.exists()
+    link_future = _EXECUTOR.submit(_get_bucket(SHORTNG_BUCKET).get_blob, _blob_name(filename))
+    password_future = _EXECUTOR.submit(_download_password_data, _password_filename(filename))
+    return link_future.result(), password_future.result()
 
 
-def _get_stored_hashed_password(filename, source):
-    bucket = _get_client().get_bucket(SHORTNG_PASSWORD_BUCKET)
-    blob_name = _blob_name(filename)
-    blob = bucket.get_blob(blob_name)
-    if blob is None or not blob.exists():
-        msg = f"Could not retrieve password file with the name {blob_name} in {SHORTNG_PASSWORD_BUCKET}"
-        logger.error(msg)
-        raise ErrMsg(msg, source)
-    data = blob.download_as_bytes()
-    return data[:DKLEN_WIDTH], data[DKLEN_WIDTH:]
+def _download_password_data(password_filename):
+    """
+    Download the stored password data for the given filename,
+    or return None if there is no password file.
+    Password files that exist are cached briefly in _PASSWORD_DATA.
+    """
+    from google.api_core.exceptions import NotFound
+
+    with _PASSWORD_DATA_LOCK:
+        if password_filename in _PASSWORD_DATA:
+            return _PASSWORD_DATA[password_filename]
+
+    blob = _get_bucket(SHORTNG_PASSWORD_BUCKET).blob(_blob_name(password_filename))
+    try:
+        # password files are never compressed (see GZIP_MIN_BYTES)
+        data = blob.download_as_bytes(checksum=None, raw_download=True)
+    except NotFound:
+        return None
 
+    with _PASSWORD_DATA_LOCK:
+        _PASSWORD_DATA[password_filename] = data
+    return data
 
-def _store_hashed_password_salt(password_filename, hashed_password, salt):
+
+def _split_password_data(data):
+    """
+    Split stored password data into the KDF parameters, the hashed password,
+    and the salt. The data is the JSON parameters, a null byte, the salt,
+    and the hash; legacy data is just the hash followed by the salt.
     """
-    Store the given password (hashed) and salt in the password bucket.
+    if len(data) == DKLEN_WIDTH + SALT_WIDTH:
+        return dict(LEGACY_KDF_PARAMS), data[:DKLEN_WIDTH], data[DKLEN_WIDTH:]
+
+    params, _, salt_and_hash = data.partition(b'\0')
+    return orjson.loads(params), salt_and_hash[SALT_WIDTH:], salt_and_hash[:SALT_WIDTH]
+
+
+def _store_hashed_password_salt(password_filename, params, hashed_password, salt):
     """
-    data = hashed_password + salt
+    Store the given password (hashed), the KDF parameters used to hash it,
+    and the salt in the password bucket. Fails with PreconditionFailed
+    if a password has been stored for the file in the meantime.
+    """
+    data = json.dumps(params).encode('utf-8') + b'\0' + salt + hashed_password
     blob_name = _blob_name(password_filename)
-    _upload_to_bucket(blob_name, data, SHORTNG_PASSWORD_BUCKET)
+    _upload_to_bucket(blob_name, data, SHORTNG_PASSWORD_BUCKET, if_generation_match=0)
 
 
-def _is_editable_password(password_filename, password, source):
+def _password_matches(params, stored_hashed_password, stored_salt, password):
     """
-    Determine whether the given filename is still editable based on password.
+    Determine whether the given password (bytes) matches the stored hashed password.
     """
+    # a missing password can't match, so don't pay for the KDF
+    if not password:
+        return False
 
-    # this check is currently redundant, but leaving it in for safety
-    if not _file_exists(SHORTNG_PASSWORD_BUCKET, password_filename):
-        return True
+    cache_key = hmac.new(_VERIFIED_PASSWORD_SECRET,
+                         stored_hashed_password + b'|' + password, 'sha256').digest()
+    with _VERIFIED_PASSWORDS_LOCK:
+        if cache_key in _VERIFIED_PASSWORDS:
+            return True
+
+    hashed_input_password = _hash_password(password, stored_salt, params)
+    matches = hmac.compare_digest(stored_hashed_password, hashed_input_password)
 
-    stored_hashed_password, stored_salt = _get_stored_hashed_password(password_filename, source)
-    hashed_input_password = _hash_password(password, stored_salt)
-    return stored_hashed_password == hashed_input_password
+    # only successes are cached, so guessing passwords always pays the full KDF cost
+    if matches:
+        with _VERIFIED_PASSWORDS_LOCK:
+            _VERIFIED_PASSWORDS[cache_key] = True
+    return matches
 
 
-def _raise_if_not_editable(filename, has_password_file, password, source):
+def _raise_if_not_editable(filename, link_blob, stored_password_data, password, source):
     """
     Raise an error if the given filename is not editable due to password
-    or age restrictions.
+    or age restrictions. The link blob (metadata) and stored password data
+    are as returned by _gather_blob_metadata().
     """
-    if _file_exists(SHORTNG_BUCKET, filename):
-        if has_password_file:
+    if link_blob is not None:
+        if stored_password_data is not None:
             # check pwd
-            if not _is_editable_password(_password_filename(filename), password, source):
+            params, stored_hashed_password, stored_salt = _split_password_data(stored_password_data)
+            if not _password_matches(params, stored_hashed_password, stored_salt, password):
                 msg = (
                     f"A password is required to overwite the link with filename {filename}. The provided password is missing or incorrect."
                 )
                 raise ErrMsg(msg, source)
         else:
             # no password; check time
-            if not _is_editable_age(filename):
+            if not _is_editable_age(link_blob):
                 msg = (
                     f"This link was last saved more than {EDIT_EXPIRATION} ago and cannot be resaved. Please create a new link instead, "
                     f"or contact the site admin to reset the editing period. Note that links with passwords can "
@@ -388,14 +767,11 @@ def _raise_if_not_editable(filename, has_password_file, password, source):
                 raise ErrMsg(msg, source)
 
 
-def _is_editable_age(filename):
+def _is_editable_age(blob):
     """
-    Determine whether the given filename is still editable based on last edit time.
+    Determine whether the given link blob is still editable based on last edit time.
     """
-
-    bucket = _get_client().get_bucket(SHORTNG_BUCKET)
-    blob = bucket.get_blob(_blob_name(filename))
-    if blob is None or not blob.exists():
+    if blob is None:
         # doesn't exist = OK to edit/create
         return True
 
@@ -407,12 +783,95 @@ def _new_salt():
     return os.urandom(SALT_WIDTH)
 
 
-def _hash_password(password, salt):
+def _kdf_params():
+    """
+    KDF parameters for hashing a newly stored password.
+    """
+    match PASSWORD_KDF:
+        case 'scrypt':
+            return {"kdf": "scrypt", "n": _scrypt_n(), "r": 8, "p": SCRYPT_P, "dklen": DKLEN_WIDTH}
+        case 'argon2id':
+            return {"kdf": "argon2id", "t": ARGON2_TIME_COST, "m": ARGON2_MEMORY_COST,
+                    "p": ARGON2_PARALLELISM, "dklen": DKLEN_WIDTH}
+        case 'pbkdf2-sha256':
+            return {"kdf": "pbkdf2-sha256", "iterations": PBKDF2_ITERS, "dklen": DKLEN_WIDTH}
+        case _:
+            raise RuntimeError(f"Unsupported password KDF: {PASSWORD_KDF}")
+
+
+@functools.cache
+def _scrypt_n():
+    """
+    The scrypt cost for new passwords: SCRYPT_N, or if SCRYPT_TARGET_MS is set,
+    the largest power-of-two multiple of it whose hash time fits that budget.
+    """
+    if not SCRYPT_TARGET_MS:
+        return SCRYPT_N
+
+    target_ms = float(SCRYPT_TARGET_MS)
+    n = SCRYPT_N
+    while n < SCRYPT_MAX_N:
+        params = {"kdf": "scrypt", "n": 2 * n, "r": 8, "p": SCRYPT_P, "dklen": DKLEN_WIDTH}
+        start = time.perf_counter()
+        _hash_password(b"calibration", _new_salt(), params)
+        if (time.perf_counter() - start) * 1000 > target_ms:
+            break
+        n *= 2
+    logger.info("Calibrated scrypt cost n=%d for a %s ms budget", n, target_ms)
+    return n
+
+
+def _hash_password(password, salt, params):
+    """
+    Hash the given password (bytes) with the given salt and KDF parameters,
+    and return the hashed password.
+    """
+    match params['kdf']:
+        case 'scrypt':
+            n, r, p = params['n'], params['r'], params['p']
+            # scrypt needs roughly 128 * r * (n + p) bytes; allow headroom above that
+            return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                                  dklen=params['dklen'], maxmem=2 * 128 * r * (n + p + 2))
+        case 'argon2id':
+            # imported only when needed, like the google libraries
+            from argon2.low_level import Type, hash_secret_raw
+            return hash_secret_raw(password, salt, time_cost=params['t'], memory_cost=params['m'],
+                                   parallelism=params['p'], hash_len=params['dklen'], type=Type.ID)
+        case 'pbkdf2-sha256':
+            return hashlib.pbkdf2_hmac('sha256', password, salt, params['iterations'], params['dklen'])
+        case _:
+            raise RuntimeError(f"Unsupported password KDF: {params['kdf']}")
+
+
+def _download_state(bucket_name, blob_name):
     """
-    Hash the given password, and return the salt and hashed password.
+    download the given JSON state from a google bucket. States in our own
+    bucket are read with the storage client, reusing its connections; any
+    other bucket (which comes from the user's link) is read anonymously via
+    its public URL, so a link can't name objects that only our service
+    account is allowed to read.
     """
-    hashed_password = hashlib.scrypt(bytes(password, encoding='utf-8'), salt=salt, n=16384, r=8, p=1, dklen=DKLEN_WIDTH)
-    return hashed_password
+    from google.api_core.exceptions import Forbidden
+
+    if bucket_name != SHORTNG_BUCKET:
+        return _download_state_public(bucket_name, blob_name)
+
+    try:
+        blob = _get_bucket(bucket_name).blob(blob_name)
+        # Skip the client-side checksum (the download is protected by TLS), and
+        # take the bytes as stored; compressed states are decompressed here.
+        data = blob.download_as_bytes(checksum=None, raw_download=True)
+        if data.startswith(GZIP_MAGIC):
+            data = gzip.decompress(data)
+        return orjson.loads(data)
+    except Forbidden as e:
+        if PUBLIC_DOWNLOAD_FALLBACK:
+            return _download_state_public(bucket_name, blob_name)
+        logger.error(f"Error downloading json state from gs://{bucket_name}/{blob_name}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Error downloading json state from gs://{bucket_name}/{blob_name}: {e}")
+        return None
 
 
 def _download_state_public(bucket_name, blob_name):
@@ -422,32 +881,87 @@ def _download_state_public(bucket_name, blob_name):
     url = f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
     try:
         with urllib.request.urlopen(url) as response:
-            return json.loads(response.read())
+            data = response.read()
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            return orjson.loads(data)
     except Exception as e:
         logger.error(f"Error downloading json state from {url}: {e}")
         return None
 
 
-def _upload_state(state, filename):
+def _upload_state(state, filename, if_generation_match=None):
     """
     Upload the given JSON state to a file in our (hard-coded) google storage bucket.
+    If if_generation_match is given, the upload only succeeds if the existing
+    file has that generation (0 means the file must not exist yet).
+    """
+
+    # orjson produces the UTF-8 bytes directly, so there's no intermediate str to encode
+    state_bytes = orjson.dumps(state, option=orjson.OPT_INDENT_2)
+    _upload_to_bucket(_blob_name(filename), state_bytes, SHORTNG_BUCKET,
+                      cache_control=STATE_CACHE_CONTROL, if_generation_match=if_generation_match)
+    return _bucket_path(filename)
+
+
+def _copy_state(blob_name, source_blob, filename, source, if_generation_match=None):
+    """
+    Copy an existing state in our bucket to the given filename, server-side.
+    source_blob is the state's blob (metadata), or None if it doesn't exist.
+    if_generation_match is as for _upload_state().
     """
+    from google.api_core.exceptions import NotFound
 
-    state_string = json.dumps(state, indent=2)
-    _upload_to_bucket(_blob_name(filename), state_string, SHORTNG_BUCKET)
+    msg = f"Could not retrieve json state from bucket {SHORTNG_BUCKET}, blob {blob_name}"
+    if source_blob is None:
+        logger.error(msg)
+        raise ErrMsg(msg, source)
 
-    bucket_path = f'{SHORTNG_BUCKET}/{_blob_name(filename)}'
-    return bucket_path
+    # Metadata sent with a rewrite replaces the source's rather than merging
+    #   with it, so carry over how the state is stored, and give the copy the
+    #   same caching as an uploaded state (older states are 'no-store').
+    destination = _get_bucket(SHORTNG_BUCKET).blob(_blob_name(filename))
+    destination.content_type = source_blob.content_type
+    destination.content_encoding = source_blob.content_encoding
+    destination.cache_control = STATE_CACHE_CONTROL
+    try:
+        # a rewrite within one bucket completes in a single call
+        token, _, _ = destination.rewrite(source_blob, if_generation_match=if_generation_match)
+        while token is not None:
+            token, _, _ = destination.rewrite(source_blob, token=token,
+                                              if_generation_match=if_generation_match)
+    except NotFound as ex:
+        logger.error(msg)
+        raise ErrMsg(msg, source) from ex
+    return _bucket_path(filename)
 
 
-def _upload_to_bucket(blob_name, blob_contents, bucket_name):
+def _upload_to_bucket(blob_name, blob_contents, bucket_name,
+                      cache_control='public, no-store', if_generation_match=None):
     """
     Upload a blob of data to the specified google storage bucket.
+    The contents may be str or bytes. Contents of GZIP_MIN_BYTES or more
+    are stored gzip-compressed, with Content-Encoding: gzip.
+    By default the blob may not be cached; pass cache_control to allow it.
+    If if_generation_match is given, GCS rejects the upload (PreconditionFailed)
+    unless the existing blob has that generation (0: the blob must not exist).
     """
-    bucket = _get_client().get_bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.cache_control = 'public, no-store'
-    blob.upload_from_string(blob_contents, content_type='application/json')
+    if isinstance(blob_contents, str):
+        blob_contents = blob_contents.encode('utf-8')
+
+    blob = _get_bucket(bucket_name).blob(blob_name)
+    blob.cache_control = cache_control
+    # States compress very well. GCS serves the blob with Content-Encoding: gzip,
+    # which browsers (and the storage client) decompress transparently.
+    if len(blob_contents) >= GZIP_MIN_BYTES:
+        blob_contents = gzip.compress(blob_contents, compresslevel=1)
+        blob.content_encoding = 'gzip'
+    # With no chunk_size set, uploads up to the client's multipart limit (8 MiB)
+    # are a single request rather than a resumable upload session. Even states
+    # near MAX_LINK_LENGTH are well under that once compressed. Skip computing
+    # a checksum of the contents on our side; the upload is protected by TLS.
+    blob.upload_from_string(blob_contents, content_type='application/json', checksum=None,
+                            if_generation_match=if_generation_match)
     return blob.public_url
 
 
@@ -457,86 +971,91 @@ def _web_response(url, bucket_path):
     along with some convenient buttons.
     """
     download_url = f"https://storage.googleapis.com/{bucket_path}"
+    # the URLs come from the user (filename, link), so escape them for HTML
+    page = _WEB_RESPONSE_PAGE.substitute(url=escape(url), download_url=escape(download_url))
+    return Response(page, 200, mimetype='text/html')
+
+
+# The page returned by _web_response(); only the URLs vary, so the rest
+# of the page is assembled once, here.
 
-    # FIXME: The proper way to do this is with a jinja template.
-
-    script = """
-        <script type="text/javascript">
-        function copy_to_clipboard(text) {
-            try {
-                navigator.clipboard.writeText(text);
-            }
-            catch (err) {
-                console.error("Couldn't write to clipboard:", err)
-            }
+_WEB_RESPONSE_SCRIPT = """
+    <script type="text/javascript">
+    function copy_to_clipboard(text) {
+        try {
+            navigator.clipboard.writeText(text);
         }
-        </script>
-        """
-
-    style = """
-        <style>
-            body {
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background-color: #f0f2f5;
-                margin: 0;
-                padding: 0;
-                display: flex;
-                justify-content: center;
-                align-items: center;
-                height: 100vh;
-            }
-            .container {
-                background-color: #ffffff;
-                padding: 30px;
-                border-radius: 10px;
-                box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-                max-width: 500px;
-                width: 100%;
-                text-align: center;
-            }
-            h3, h4 {
-                color: #333;
-                margin: 10px 0;
-            }
-            button, .button {
-                background-color: #007bff;
-                color: white;
-                border: none;
-                padding: 10px 20px;
-                margin: 5px;
-                border-radius: 5px;
-                cursor: pointer;
-                font-size: 16px;
-                font-weight: normal;
-                text-decoration:none;
-            }
-            button:hover, .button:hover {
-                background-color: #0056b3;
-            }
-        </style>
-        """
-
-    page = dedent(f"""
-        <!doctype html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Shortened link</title>
-            {style}
-            {script}
-        </head>
-        <body>
-            <div class="container">
-                <h3>Your shortened link:</h3>
-                <p><a href="{url}">{url}</a></p>
-                <h4>
-                    <button onclick="copy_to_clipboard('{url}'); return false;">Copy Link</button>
-                    <a class="button" href="{download_url}">View JSON</a>
-                    <a class="button" href="shortener.html">Start Over</a>
-                </h4>
-            </div>
-        </body>
-        </html>
-        """)
-    return Response(page, 200, mimetype='text/html')
+        catch (err) {
+            console.error("Couldn't write to clipboard:", err)
+        }
+    }
+    </script>
+    """
+
+_WEB_RESPONSE_STYLE = """
+    <style>
+        body {
+            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+            background-color: #f0f2f5;
+            margin: 0;
+            padding: 0;
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            height: 100vh;
+        }
+        .container {
+            background-color: #ffffff;
+            padding: 30px;
+            border-radius: 10px;
+            box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
+            max-width: 500px;
+            width: 100%;
+            text-align: center;
+        }
+        h3, h4 {
+            color: #333;
+            margin: 10px 0;
+        }
+        button, .button {
+            background-color: #007bff;
+            color: white;
+            border: none;
+            padding: 10px 20px;
+            margin: 5px;
+            border-radius: 5px;
+            cursor: pointer;
+            font-size: 16px;
+            font-weight: normal;
+            text-decoration:none;
+        }
+        button:hover, .button:hover {
+            background-color: #0056b3;
+        }
+    </style>
+    """
+
+# FIXME: The proper way to do this is with a jinja template.
+_WEB_RESPONSE_PAGE = string.Template(dedent(f"""
+    <!doctype html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Shortened link</title>
+        {_WEB_RESPONSE_STYLE}
+        {_WEB_RESPONSE_SCRIPT}
+    </head>
+    <body>
+        <div class="container">
+            <h3>Your shortened link:</h3>
+            <p><a href="$url">$url</a></p>
+            <h4>
+                <button data-url="$url" onclick="copy_to_clipboard(this.dataset.url); return false;">Copy Link</button>
+                <a class="button" href="$download_url">View JSON</a>
+                <a class="button" href="shortener.html">Start Over</a>
+            </h4>
+        </div>
+    </body>
+    </html>
+    """))
@@ -0,0 +1,11 @@
+import os
+
+import pytest
+
+
+# the server reads its credentials from GOOGLE_APPLICATION_CREDENTIALS_CONTENTS;
+# set it once for the whole test session from the usual credentials file
+@pytest.fixture(autouse=True, scope="session")
+def setup_credentials():
+    with open(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], 'r') as f:
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS_CONTENTS'] = f.read()
@@ -2,50 +2,94 @@ import json
 import logging
 import os
 from pathlib import Path
+from types import MappingProxyType
 
 import pytest
 
+import shortener.shortng
 from shortener.app import app
-from shortener.shortng import (ErrMsg, _is_editable_password, logger, _parse_link,
-                               _parse_request, _parse_state, RequestSource, CLIO_URL)
+from shortener.shortng import (ErrMsg, _download_password_data, logger, _parse_link,
+                               _parse_request, _parse_state, RequestSource, CLIO_URL,
+                               _hash_password, _password_matches, _split_password_data,
+                               LEGACY_KDF_PARAMS, MAX_LINK_LENGTH, _process_filename,
+                               _download_state, _web_response)
 
 FILENAME = "test-filename"
 TITLE = "This is a test title"
 PASSWORD = "myTestPassword"
+# the stored name _parse_request() makes from FILENAME
+FILENAME_JSON = f"{FILENAME}.json"
 # this is not a valid neuroglancer link, but it's enough for testing parsing
 LINK = "http://neuroglancer.janelia.org"
 
 # for testing:
 HEMIBRAIN_DOMAIN = "https://neuroglancer-demo.appspot.com/"
 
-WEB_HEADERS = {
+WEB_HEADERS = MappingProxyType({
     'Content-Type': 'application/x-www-form-urlencoded',
     'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0',
-    }
+})
 
-API_HEADERS = {
+API_HEADERS = MappingProxyType({
     'Content-Type': 'application/json',
     'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0',
-    }
+})
 
-SLACK_HEADERS = {
+SLACK_HEADERS = MappingProxyType({
     'Content-Type': 'application/x-www-form-urlencoded',
     'User-Agent': 'Slackbot',
-    }
-
-
-@pytest.fixture(autouse=True)
+})
+
+# request bodies shared by the parsing tests; read-only so no test can leak changes into another
+WEB_FORM = MappingProxyType({
+    "filename": FILENAME,
+    "title": TITLE,
+    "password": PASSWORD,
+    "text": LINK,
+    "client": "web",
+})
+WEB_FORM_NO_LINK = MappingProxyType({
+    "filename": FILENAME,
+    "title": TITLE,
+    "password": PASSWORD,
+    "client": "web",
+})
+WEB_FORM_LINK_ONLY = MappingProxyType({
+    "text": LINK,
+    "client": "web",
+})
+
+API_FORM = MappingProxyType({
+    "filename": FILENAME,
+    "title": TITLE,
+    "password": PASSWORD,
+    "text": LINK,
+})
+API_FORM_NO_LINK = MappingProxyType({
+    "filename": FILENAME,
+    "title": TITLE,
+})
+API_FORM_LINK_ONLY = MappingProxyType({
+    "text": LINK,
+})
+
+API_JSON = json.dumps(dict(API_FORM))
+API_JSON_NO_LINK = json.dumps(dict(API_FORM_NO_LINK))
+API_JSON_LINK_ONLY = json.dumps(dict(API_FORM_LINK_ONLY))
+
+SLACK_FORM = MappingProxyType({"text": f"{FILENAME} {LINK}"})
+SLACK_FORM_EMPTY = MappingProxyType({"text": ""})
+SLACK_FORM_NO_TEXT = MappingProxyType({"command": "/shortng"})
+SLACK_FORM_LINK_ONLY = MappingProxyType({"text": LINK})
+
+
+@pytest.fixture(autouse=True, scope="module")
 def setup_logger():
     logger.setLevel(logging.WARNING)
 
 
-@pytest.fixture(autouse=True)
-def setup_credentials():
-    with open(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], 'r') as f:
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS_CONTENTS'] = f.read()
-
-
-@pytest.fixture
+# the files are read once per module; tests must not modify the returned state
+@pytest.fixture(scope="module")
 def hemibrain_data():
     test_dir_base = os.path.dirname(__file__)
 
@@ -65,209 +109,127 @@ def hemibrain_data():
     return hemibrain_link, hemibrain_json
 
 
-def test_parse_web():
-    with app.test_request_context(
-        "/shortng",
-        headers=WEB_HEADERS,
-        data={
-            "filename": FILENAME,
-            "title": TITLE,
-            "password": PASSWORD,
-            "text": LINK,
-            "client": "web",
-        },
-    ):
+# a filename of None means _parse_request() should have generated a default name
+@pytest.mark.parametrize("headers, data, expected_source, expected_filename, expected_title, expected_password", [
+    pytest.param(WEB_HEADERS, WEB_FORM, RequestSource.WEB, FILENAME_JSON, TITLE, PASSWORD,
+                 id="web"),
+    pytest.param(WEB_HEADERS, WEB_FORM_LINK_ONLY, RequestSource.WEB, None, None, "",
+                 id="web_no_filename_title_pwd"),
+    pytest.param(SLACK_HEADERS, SLACK_FORM, RequestSource.SLACK, FILENAME_JSON, None, "",
+                 id="slack"),
+    pytest.param(SLACK_HEADERS, SLACK_FORM_LINK_ONLY, RequestSource.SLACK, None, None, "",
+                 id="slack_no_filename"),
+    pytest.param(WEB_HEADERS, API_FORM, RequestSource.API_PLAIN, FILENAME_JSON, TITLE, PASSWORD,
+                 id="api_text"),
+    pytest.param(WEB_HEADERS, API_FORM_LINK_ONLY, RequestSource.API_PLAIN, None, None, "",
+                 id="api_text_no_filename_title_pwd"),
+    pytest.param(API_HEADERS, API_JSON, RequestSource.API_JSON, FILENAME_JSON, TITLE, PASSWORD,
+                 id="api_json"),
+    pytest.param(API_HEADERS, API_JSON_LINK_ONLY, RequestSource.API_JSON, None, None, "",
+                 id="api_json_no_filename_title"),
+    pytest.param({'Content-Type': 'application/json'}, API_JSON_LINK_ONLY, RequestSource.API_JSON, None, None, "",
+                 id="api_json_no_user_agent"),
+])
+def test_parse_request(headers, data, expected_source, expected_filename, expected_title, expected_password):
+    with app.test_request_context("/shortng", headers=headers, data=data):
         filename, title, password, link, source = _parse_request()
-        assert filename == f"{FILENAME}.json"
-        assert title == TITLE
-        assert password == PASSWORD
-        assert link == LINK
-        assert source is RequestSource.WEB
-
 
-def test_parse_web_no_link():
-    with app.test_request_context(
-        "/shortng",
-        headers=WEB_HEADERS,
-        data={
-            "filename": FILENAME,
-            "title": TITLE,
-            "password": PASSWORD,
-            "client": "web",
-        },
-    ):
+    if expected_filename is None:
+        assert filename.endswith(".json")
+    else:
+        assert filename == expected_filename
+    assert title == expected_title
+    assert password == expected_password
+    assert link == LINK
+    assert source is expected_source
+
+
+@pytest.mark.parametrize("headers, data", [
+    pytest.param(WEB_HEADERS, WEB_FORM_NO_LINK, id="web_no_link"),
+    pytest.param(SLACK_HEADERS, SLACK_FORM_EMPTY, id="slack_no_link"),
+    pytest.param(SLACK_HEADERS, SLACK_FORM_NO_TEXT, id="slack_no_text"),
+    pytest.param(WEB_HEADERS, API_FORM_NO_LINK, id="api_text_no_link"),
+    pytest.param(API_HEADERS, API_JSON_NO_LINK, id="api_json_no_link"),
+])
+def test_parse_request_no_link(headers, data):
+    with app.test_request_context("/shortng", headers=headers, data=data):
         with pytest.raises(ErrMsg):
             _parse_request()
 
 
-def test_parse_web_no_filename_title_pwd():
+def test_parse_web_large_link():
+    # large form bodies are parsed separately from ordinary ones
+    long_link = f"{LINK}/{'x' * 100_000}"
     with app.test_request_context(
         "/shortng",
         headers=WEB_HEADERS,
-        data={
-            "text": LINK,
-            "client": "web",
-        },
+        data={**WEB_FORM, "text": long_link},
     ):
         filename, title, password, link, source = _parse_request()
-        assert filename.endswith(".json")
-        assert title is None
-        assert password == ""
-        assert link == LINK
-        assert source is RequestSource.WEB
 
+    assert filename == FILENAME_JSON
+    assert title == TITLE
+    assert password == PASSWORD
+    assert link == long_link
+    assert source is RequestSource.WEB
 
-def test_parse_slack():
-    with app.test_request_context(
-        "/shortng",
-        headers=SLACK_HEADERS,
-        data={
-            "text": f"{FILENAME} {LINK}",
-        },
-    ):
-        filename, title, password, link, source = _parse_request()
-        assert filename == f"{FILENAME}.json"
-        assert title is None
-        assert password == ""
-        assert link == LINK
-        assert source is RequestSource.SLACK
 
-
-def test_parse_slack_no_link():
-    with app.test_request_context(
-        "/shortng",
-        headers=SLACK_HEADERS,
-        data={
-            "text": "",
-        },
-    ):
-        with pytest.raises(ErrMsg):
-            _parse_request()
+def test_default_filename_unique():
+    filenames = [_process_filename("") for _ in range(1000)]
+    assert len(set(filenames)) == len(filenames)
+    assert all(f.endswith(".json") for f in filenames)
 
 
-def test_parse_slack_no_filename():
-    with app.test_request_context(
-        "/shortng",
-        headers=SLACK_HEADERS,
-        data={
-            "text": f"{LINK}",
-        },
-    ):
-        filename, title, password, link, source = _parse_request()
-        assert filename.endswith(".json")
-        assert title is None
-        assert password == ""
-        assert link == LINK
-        assert source is RequestSource.SLACK
-
-
-def test_parse_api_text():
-    with app.test_request_context(
-        "/shortng",
-        headers=WEB_HEADERS,
-        data={
-            "filename": FILENAME,
-            "title": TITLE,
-            "password": PASSWORD,
-            "text": LINK,
-        },
-    ):
-        filename, title, password, link, source = _parse_request()
-        assert filename == f"{FILENAME}.json"
-        assert title == TITLE
-        assert password == PASSWORD
-        assert link == LINK
-        assert source is RequestSource.API_PLAIN
+def test_parse_link(hemibrain_data):
+    hemibrain_link, hemibrain_json = hemibrain_data
+    domain, state = _parse_state(hemibrain_link, RequestSource.WEB)
+    assert domain == HEMIBRAIN_DOMAIN
+    assert state == hemibrain_json
 
 
-def test_parse_api_text_no_filename_title_pwd():
-    with app.test_request_context(
-        "/shortng",
-        headers=WEB_HEADERS,
-        data={
-            "text": LINK,
-        },
-    ):
-        filename, title, password, link, source = _parse_request()
-        assert filename.endswith(".json")
-        assert title is None
-        assert password == ""
-        assert link == LINK
-        assert source is RequestSource.API_PLAIN
-
+def test_parse_link_invalid():
+    # there are lots of ways this can fail; just try one
+    with pytest.raises(ErrMsg):
+        _parse_state("https://not a valid link/jsonstuff", RequestSource.WEB)
 
-def test_parse_api_text_no_link():
-    with app.test_request_context(
-        "/shortng",
-        headers=WEB_HEADERS,
-        data={
-            "filename": FILENAME,
-            "title": TITLE,
-        },
-    ):
-        with pytest.raises(ErrMsg):
-            _parse_request()
 
+def test_parse_link_not_object():
+    with pytest.raises(ErrMsg):
+        _parse_state("https://neuroglancer/#!%5B1%2C2%5D", RequestSource.WEB)
 
-def test_parse_api_json():
-    with app.test_request_context(
-        "/shortng",
-        headers=API_HEADERS,
-        data=json.dumps({
-            "filename": FILENAME,
-            "title": TITLE,
-            "password": PASSWORD,
-            "text": LINK,
-        }),
-    ):
-        filename, title, password, link, source = _parse_request()
-        assert filename == f"{FILENAME}.json"
-        assert title == TITLE
-        assert password == PASSWORD
-        assert link == LINK
-        assert source is RequestSource.API_JSON
 
+def test_parse_link_too_long():
+    with pytest.raises(ErrMsg):
+        _parse_state("https://neuroglancer/#!" + "x" * MAX_LINK_LENGTH, RequestSource.WEB)
 
-def test_parse_api_json_no_filename_title():
-    with app.test_request_context(
-        "/shortng",
-        headers=API_HEADERS,
-        data=json.dumps({
-            "text": LINK,
-        }),
-    ):
-        filename, title, password, link, source = _parse_request()
-        assert filename.endswith(".json")
-        assert title is None
-        assert password == ""
-        assert link == LINK
-        assert source is RequestSource.API_JSON
 
+def test_parse_short_link_bad_scheme(monkeypatch):
+    # shortened links must be checked too, before their state is fetched
+    monkeypatch.setattr(shortener.shortng, '_download_state', lambda bucket_name, blob_name: {})
+    with pytest.raises(ErrMsg):
+        _parse_state("javascript:alert(document.domain)//#!gs://flyem-user-links/short/a.json", RequestSource.WEB)
 
-def test_parse_api_json_no_link():
-    with app.test_request_context(
-        "/shortng",
-        headers=API_HEADERS,
-        data=json.dumps({
-            "filename": FILENAME,
-            "title": TITLE,
-        }),
-    ):
-        with pytest.raises(ErrMsg):
-            _parse_request()
 
+def test_copy_short_link_bad_scheme(monkeypatch):
+    # re-saving a short link unchanged copies it without fetching the state
+    def no_gcs(filename):
+        raise AssertionError("the link should have been rejected before reaching GCS")
 
-def test_parse_link(hemibrain_data):
-    hemibrain_link, hemibrain_json = hemibrain_data
-    domain, state = _parse_state(hemibrain_link, RequestSource.WEB)
-    assert domain == HEMIBRAIN_DOMAIN
-    assert state == hemibrain_json
+    monkeypatch.setattr(shortener.shortng, '_gather_blob_metadata', no_gcs)
+    response = app.test_client().post("/shortng", headers=WEB_HEADERS, data={
+        "filename": FILENAME,
+        "text": "javascript:alert(document.domain)//#!gs://flyem-user-links/short/a.json",
+        "client": "web",
+    })
+    assert response.status_code == 400
+    assert b"javascript:" not in response.data
 
 
-def test_parse_link_invalid():
-    # there are lots of ways this can fail; just try one
-    with pytest.raises(ErrMsg):
-        _parse_state("https://not a valid link/jsonstuff", RequestSource.WEB)
+def test_web_response_escapes_urls():
+    attack = '"><img src=x onerror=alert(1)>'
+    page = _web_response(f"{LINK}/#!{attack}", f"flyem-user-links/short/{attack}.json").get_data(as_text=True)
+    assert attack not in page
+    assert "&#34;&gt;&lt;img src=x onerror=alert(1)&gt;" in page
 
 
 def test_parse_json(hemibrain_data):
@@ -302,6 +264,20 @@ def test_parse_short_link_invalid():
         _parse_state("https://clio-ng.janelia.org/#!gs://flyem-user-links/short/no-such-link-exists", RequestSource.WEB)
 
 
+def test_download_state_other_bucket(monkeypatch):
+    # states in buckets other than ours must never be read with our credentials
+    def no_client(bucket_name):
+        raise AssertionError(f"the storage client was used for bucket {bucket_name}")
+
+    public_downloads = []
+    monkeypatch.setattr(shortener.shortng, '_get_bucket', no_client)
+    monkeypatch.setattr(shortener.shortng, '_download_state_public',
+                        lambda bucket_name, blob_name: public_downloads.append((bucket_name, blob_name)) or {})
+
+    assert _download_state("flyem-private", "secret.json") == {}
+    assert public_downloads == [("flyem-private", "secret.json")]
+
+
 def test_parse_short_link_main_bucket():
     # test we are not sensitive to the bucket name (this test and next one)
     url_base, bucket_name, blob_name = _parse_link("https://clio-ng.janelia.org/#!gs://flyem-user-links/short/djo-test-hemibrain.json")
@@ -319,5 +295,26 @@ def test_parse_short_link_other_bucket():
 
 def test_check_password():
     # this is a known stored password
-    assert _is_editable_password("djo-test-pwd", "pwd-pwd", RequestSource.WEB)
-    assert not _is_editable_password("djo-test-pwd", "wrong-pwd", RequestSource.WEB)
+    params, hashed_password, salt = _split_password_data(_download_password_data("djo-test-pwd"))
+    assert _password_matches(params, hashed_password, salt, b"pwd-pwd")
+    assert not _password_matches(params, hashed_password, salt, b"wrong-pwd")
+
+
+@pytest.mark.parametrize("params", [
+    {"kdf": "scrypt", "n": 1024, "r": 8, "p": 1, "dklen": 32},
+    {"kdf": "argon2id", "t": 1, "m": 1024, "p": 2, "dklen": 32},
+    {"kdf": "pbkdf2-sha256", "iterations": 1000, "dklen": 32},
+])
+def test_split_password_data(params):
+    salt = b"0123456789abcdef"
+    hashed_password = _hash_password(PASSWORD.encode(), salt, params)
+
+    # legacy format: hash followed by salt, no parameters
+    assert _split_password_data(hashed_password + salt) == (LEGACY_KDF_PARAMS, hashed_password, salt)
+
+    data = json.dumps(params).encode('utf-8') + b"\0" + salt + hashed_password
+    assert _split_password_data(data) == (params, hashed_password, salt)
+    assert _password_matches(params, hashed_password, salt, PASSWORD.encode())
+    assert not _password_matches(params, hashed_password, salt, b"wrong-pwd")
+    assert not _password_matches(params, hashed_password, salt, b"")
+    assert not _password_matches(params, hashed_password, salt, None)
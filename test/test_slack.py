@@ -0,0 +1,57 @@
+import contextlib
+import json
+import threading
+
+import pytest
+
+import shortener.shortng
+from shortener.app import app
+
+FILENAME = "test-filename"
+
+SLACK_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'User-Agent': 'Slackbot',
+    }
+
+RESPONSE_URL = "https://hooks.slack.com/commands/T0/1/abc"
+
+
+@pytest.mark.parametrize("upload_fails", [False, True], ids=["saved", "failed"])
+def test_slack_deferred_reply(monkeypatch, upload_fails):
+    # an upload that outlasts Slack's deadline is reported via the response_url
+    release_upload = threading.Event()
+    replied = threading.Event()
+    replies = []
+
+    def slow_upload(state, filename, if_generation_match=None):
+        release_upload.wait(5)
+        if upload_fails:
+            raise RuntimeError("internal storage error details")
+
+    def fake_urlopen(slack_request, timeout=None):
+        replies.append((slack_request.full_url, json.loads(slack_request.data)))
+        replied.set()
+        return contextlib.nullcontext()
+
+    monkeypatch.setattr(shortener.shortng, 'SLACK_REPLY_SECONDS', 0.01)
+    monkeypatch.setattr(shortener.shortng, '_gather_blob_metadata', lambda filename: (None, None))
+    monkeypatch.setattr(shortener.shortng, '_upload_state', slow_upload)
+    monkeypatch.setattr(shortener.shortng.urllib.request, 'urlopen', fake_urlopen)
+
+    response = app.test_client().post("/shortng", headers=SLACK_HEADERS, data={
+        "text": f"{FILENAME} https://neuroglancer/#!%7B%7D",
+        "response_url": RESPONSE_URL,
+    })
+    assert response.status_code == 200
+    assert not replies
+
+    release_upload.set()
+    assert replied.wait(5)
+    [(url, body)] = replies
+    assert url == RESPONSE_URL
+    if upload_fails:
+        assert "internal" not in body["text"]
+        assert "could not be saved" in body["text"]
+    else:
+        assert body["text"] == f"https://neuroglancer/#!gs://flyem-user-links/short/{FILENAME}.json"